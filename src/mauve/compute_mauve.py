@@ -1,15 +1,25 @@
 # Author: Krishna Pillutla
 # License: GPLv3
 
-import math
+import hashlib
+import os
 import numpy as np
 import time
 from types import SimpleNamespace
 
 import faiss
+
+if os.environ.get("MAUVE_USE_SKLEARNEX", "0") == "1":
+    # oneDAL-accelerated PCA; must be patched in before PCA is imported below
+    try:
+        from sklearnex import patch_sklearn
+
+        patch_sklearn(["pca"], verbose=False)
+    except (ImportError, ModuleNotFoundError):
+        pass
+
 from sklearn.preprocessing import normalize
 from sklearn.decomposition import PCA
-from sklearn.metrics import auc as compute_area_under_curve
 
 try:
     import torch
@@ -34,8 +44,14 @@ if FOUND_TORCH and FOUND_TRANSFORMERS:
         get_device_from_arg,
     )
 
+if FOUND_TORCH:
+    # only needed for the "torch" k-means backend
+    from .kmeans import KMeans
+
 
 MODEL, TOKENIZER, MODEL_NAME = None, None, None
+# histograms of recent calls to cluster_feats, keyed by their features and arguments
+CLUSTER_CACHE, CLUSTER_CACHE_SIZE = {}, 16
 
 
 def compute_mauve(
@@ -50,6 +66,9 @@ def compute_mauve(
     kmeans_explained_var=0.9,
     kmeans_num_redo=5,
     kmeans_max_iter=500,
+    kmeans_backend="faiss",
+    kmeans_matmul_dtype=None,
+    kmeans_use_compile=False,
     featurize_model_name="gpt2-large",
     device_id=-1,
     max_text_length=1024,
@@ -78,6 +97,12 @@ def compute_mauve(
         Try reducing this to 1 in order to reduce running time.
     :param ``kmeans_max_iter``: maximum number of k-means iterations. Default 500.
         Try reducing this to 100 in order to reduce running time.
+    :param ``kmeans_backend``: implementation of k-means. Options: ``'faiss'`` (default, runs on GPU if faiss finds one)
+        or ``'torch'`` (spherical k-means in PyTorch, runs on GPU if available).
+    :param ``kmeans_matmul_dtype``: with ``kmeans_backend='torch'``, the dtype of the distance computations,
+        e.g. ``torch.bfloat16`` to use tensor cores on recent GPUs. Default None (float32).
+    :param ``kmeans_use_compile``: with ``kmeans_backend='torch'``, compile the k-means iteration with ``torch.compile``.
+        Default False. Compilation takes a while, so this only pays off for large data.
     :param ``featurize_model_name``: name of the model from which features are obtained. Default 'gpt2-large'.
         We support all models which can be loaded from ``transformers.AutoModel.from_pretrained(featurize_model_name)``.
     :param ``device_id``: Device for featurization. Supply gpu_id (e.g. 0 or 3) to use GPU or -1 to use CPU.
@@ -89,6 +114,8 @@ def compute_mauve(
     :param ``verbose``: If True, print running time updates.
     :param ``seed``: random seed to initialize k-means cluster assignments.
     :param ``batch_size``: Batch size for feature extraction
+    :param ``use_float64``: If True, featurize in float64. This only affects the featurization;
+        PCA and k-means always run in float32.
 
     :return: an object with fields p_hist, q_hist, divergence_curve and mauve.
 
@@ -149,6 +176,9 @@ def compute_mauve(
         max_iter=kmeans_max_iter,
         seed=seed,
         verbose=verbose,
+        kmeans_backend=kmeans_backend,
+        kmeans_matmul_dtype=kmeans_matmul_dtype,
+        kmeans_use_compile=kmeans_use_compile,
     )
     t2 = time.time()
     if verbose:
@@ -208,32 +238,17 @@ def get_features_from_input(
                 """
             )
 
+        load_model_and_tokenizer(featurize_model_name, device_id, verbose=verbose)
         if tokenized_texts is None:
             # tokenize texts
-            if TOKENIZER is None or MODEL_NAME != featurize_model_name:
-                if verbose:
-                    print("Loading tokenizer")
-                TOKENIZER = get_tokenizer(featurize_model_name)
             if verbose:
                 print("Tokenizing text...")
+            # a single batched call lets fast tokenizers tokenize in parallel
+            encodings = TOKENIZER(texts, truncation=True, max_length=max_len)
             tokenized_texts = [
-                TOKENIZER.encode(
-                    sen, return_tensors="pt", truncation=True, max_length=max_len
-                )
-                for sen in texts
+                torch.LongTensor(ids).unsqueeze(0) for ids in encodings["input_ids"]
             ]
         # use tokenized_texts to featurize
-        if TOKENIZER is None or MODEL_NAME != featurize_model_name:
-            if verbose:
-                print("Loading tokenizer")
-            TOKENIZER = get_tokenizer(featurize_model_name)
-        if MODEL is None or MODEL_NAME != featurize_model_name:
-            if verbose:
-                print("Loading model")
-            MODEL = get_model(featurize_model_name, TOKENIZER, device_id)
-            MODEL_NAME = featurize_model_name
-        else:
-            MODEL = MODEL.to(get_device_from_arg(device_id))
         if use_float64:
             MODEL = MODEL.double()
         if verbose:
@@ -249,6 +264,23 @@ def get_features_from_input(
     return features
 
 
+def load_model_and_tokenizer(featurize_model_name, device_id, verbose=False):
+    global MODEL, TOKENIZER, MODEL_NAME
+    if MODEL is None or MODEL_NAME != featurize_model_name:
+        if verbose:
+            print("Loading tokenizer")
+        TOKENIZER = get_tokenizer(featurize_model_name)
+        if verbose:
+            print("Loading model")
+        MODEL = get_model(featurize_model_name, TOKENIZER, device_id)
+        MODEL_NAME = featurize_model_name
+    else:
+        # moving a large model is costly even when it is already on the device
+        device = get_device_from_arg(device_id)
+        if next(MODEL.parameters()).device != device:
+            MODEL = MODEL.to(device)
+
+
 def cluster_feats(
     p,
     q,
@@ -261,15 +293,44 @@ def cluster_feats(
     max_iter=500,
     seed=0,
     verbose=False,
+    kmeans_backend="faiss",
+    kmeans_matmul_dtype=None,
+    kmeans_use_compile=False,
 ):
     assert 0 < explained_variance < 1
     if verbose:
         print(f"seed = {seed}")
     assert norm in ["none", "l2", "l1", None]
-    data1 = np.vstack([q, p])
+    assert kmeans_backend in ["faiss", "torch"]
+    key = (
+        hash_features(p),
+        hash_features(q),
+        num_clusters,
+        norm,
+        whiten,
+        pca_max_data,
+        explained_variance,
+        num_redo,
+        max_iter,
+        seed,
+        kmeans_backend,
+        kmeans_matmul_dtype,
+        kmeans_use_compile,
+    )
+    if key in CLUSTER_CACHE:
+        if verbose:
+            print("reusing the clustering of a previous call")
+        p_hist, q_hist = CLUSTER_CACHE[key]
+        return p_hist.copy(), q_hist.copy()
+    # clustering is done in float32 irrespective of the precision of the features
+    num_q = q.shape[0]
+    data1 = np.empty((num_q + p.shape[0], q.shape[1]), dtype=np.float32)
+    data1[:num_q] = q
+    data1[num_q:] = p
     if norm in ["l2", "l1"]:
-        data1 = normalize(data1, norm=norm, axis=1)
-    pca = PCA(n_components=None, whiten=whiten, random_state=seed + 1)
+        data1 = normalize(data1, norm=norm, axis=1, copy=False)
+    # a float n_components keeps the fewest components explaining that much variance
+    pca = PCA(n_components=explained_variance, whiten=whiten, random_state=seed + 1)
     if pca_max_data < 0 or pca_max_data >= data1.shape[0]:
         pca.fit(data1)
     elif 0 < pca_max_data < data1.shape[0]:
@@ -280,189 +341,104 @@ def cluster_feats(
         raise ValueError(
             f"Invalid argument pca_max_data={pca_max_data} with {data1.shape[0]} datapoints"
         )
-    s = np.cumsum(pca.explained_variance_ratio_)
-    idx = np.argmax(s >= explained_variance)  # last index to consider
     if verbose:
-        print(f"performing clustering in lower dimension = {idx}")
-    data1 = pca.transform(data1)[:, : idx + 1]
+        print(f"performing clustering in lower dimension = {pca.n_components_}")
+    data1 = pca.transform(data1)
     # Cluster
-    data1 = data1.astype(np.float32)
-    """
-    t1 = time.time()
-    print(f"k-means by faiss")
-    kmeans = faiss.Kmeans(data1.shape[1], num_clusters, niter=max_iter,
-                          verbose=verbose, nredo=num_redo, update_index=True,
-                          seed=seed+2, gpu=True)
-    kmeans.train(data1)
-    _, labels = kmeans.index.search(data1, 1)
-    labels = labels.reshape(-1)
-    t2 = time.time()
-    if verbose:
-        print('kmeans time:', round(t2-t1, 2), 's') # 668.27 s
-    """
+    data1 = data1.astype(np.float32, copy=False)
     t1 = time.time()
-    print(f"k-means by me")
-    kmeans = KMeans(n_clusters=num_clusters, n_init=num_redo, max_iter=max_iter)
-    clusters = kmeans.fit(torch.from_numpy(data1).cuda())
-    labels = [None] * data1.shape[0]
-    for i, cluster in enumerate(clusters):
-        for index in cluster:
-            labels[index] = i
-    labels = np.array(labels)
+    if kmeans_backend == "faiss":
+        kmeans = faiss.Kmeans(
+            data1.shape[1],
+            num_clusters,
+            niter=max_iter,
+            verbose=verbose,
+            nredo=num_redo,
+            update_index=True,
+            seed=seed + 2,
+            gpu=faiss.get_num_gpus() > 0,
+        )
+        kmeans.train(data1)
+        _, labels = kmeans.index.search(data1, 1)
+        labels = labels.reshape(-1)
+    else:
+        if not FOUND_TORCH:
+            raise ModuleNotFoundError(
+                """PyTorch not found. Please install PyTorch if you would like to use kmeans_backend="torch".
+                    For details, see `https://pytorch.org/get-started/locally/`.
+                """
+            )
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        kmeans = KMeans(
+            n_clusters=num_clusters,
+            n_init=num_redo,
+            max_iter=max_iter,
+            device=device,
+            seed=seed + 2,
+            matmul_dtype=kmeans_matmul_dtype,
+            use_compile=kmeans_use_compile,
+            verbose=verbose,
+        )
+        labels = kmeans.fit(torch.from_numpy(data1)).cpu().numpy()
     t2 = time.time()
     if verbose:
-        print("kmeans time:", round(t2 - t1, 2), "s")  # 0.65 s
+        print("kmeans time:", round(t2 - t1, 2), "s")
+
+    q_labels = labels[:num_q]
+    p_labels = labels[num_q:]
 
-    q_labels = labels[: len(q)]
-    p_labels = labels[len(q) :]
+    q_bins = np.bincount(q_labels, minlength=num_clusters).astype(np.float64)
+    p_bins = np.bincount(p_labels, minlength=num_clusters).astype(np.float64)
+    p_hist, q_hist = p_bins / p_bins.sum(), q_bins / q_bins.sum()
+    if len(CLUSTER_CACHE) >= CLUSTER_CACHE_SIZE:
+        CLUSTER_CACHE.pop(next(iter(CLUSTER_CACHE)))  # oldest entry
+    CLUSTER_CACHE[key] = (p_hist.copy(), q_hist.copy())
+    return p_hist, q_hist
 
-    q_bins = np.histogram(
-        q_labels, bins=num_clusters, range=[0, num_clusters], density=True
-    )[0]
-    p_bins = np.histogram(
-        p_labels, bins=num_clusters, range=[0, num_clusters], density=True
-    )[0]
-    return p_bins / p_bins.sum(), q_bins / q_bins.sum()
+
+def hash_features(features):
+    features = np.ascontiguousarray(features)
+    digest = hashlib.blake2b(features, digest_size=16).hexdigest()
+    return features.shape, features.dtype.str, digest
+
+
+def compute_area_under_curve(x, y):
+    # trapezoidal rule; x must be sorted
+    return np.sum(np.diff(x) * (y[1:] + y[:-1])) / 2
 
 
 def kl_multinomial(p, q):
-    assert p.shape == q.shape
-    if np.logical_and(p != 0, q == 0).any():
-        return np.inf
-    else:
-        idxs = np.logical_and(p != 0, q != 0)
-        return np.sum(p[idxs] * np.log(p[idxs] / q[idxs]))
+    # KL(p || q) along the last axis, where p and q are broadcast against each other
+    p, q = np.broadcast_arrays(p, q)
+    idxs = np.logical_and(p != 0, q != 0)
+    terms = np.zeros(p.shape)
+    terms[idxs] = p[idxs] * np.log(p[idxs] / q[idxs])
+    is_inf = np.logical_and(p != 0, q == 0).any(axis=-1)
+    return np.where(is_inf, np.inf, terms.sum(axis=-1))[()]
 
 
 def get_divergence_curve_for_multinomials(p, q, mixture_weights, scaling_factor):
     # TODO: check if extreme points are needed
-    divergence_curve = [[0, np.inf]]  # extreme point
-    for w in np.sort(mixture_weights):
-        r = w * p + (1 - w) * q
-        divergence_curve.append([kl_multinomial(q, r), kl_multinomial(p, r)])
-    divergence_curve.append([np.inf, 0])  # other extreme point
-    return np.exp(-scaling_factor * np.asarray(divergence_curve))
+    w = np.sort(mixture_weights)[:, None]
+    r = w * p + (1 - w) * q  # one mixture per row
+    divergence_curve = np.concatenate(
+        [
+            [[0, np.inf]],  # extreme point
+            np.stack([kl_multinomial(q, r), kl_multinomial(p, r)], axis=1),
+            [[np.inf, 0]],  # other extreme point
+        ]
+    )
+    return np.exp(-scaling_factor * divergence_curve)
 
 
 def get_fronter_integral(p, q, scaling_factor=2):
-    total = 0.0
-    for p1, q1 in zip(p, q):
-        if p1 == 0 and q1 == 0:
-            pass
-        elif p1 == 0:
-            total += q1 / 4
-        elif q1 == 0:
-            total += p1 / 4
-        elif abs(p1 - q1) > 1e-8:
-            t1 = p1 + q1
-            t2 = p1 * q1 * (math.log(p1) - math.log(q1)) / (p1 - q1)
-            total += 0.25 * t1 - 0.5 * t2
-        # else: contribution is 0
+    p, q = np.asarray(p), np.asarray(q)
+    # contribution of the buckets where exactly one of p and q is 0
+    total = 0.25 * (np.sum(p[q == 0]) + np.sum(q[p == 0]))
+    # buckets where p and q are (nearly) equal contribute 0
+    idxs = (p != 0) & (q != 0) & (np.abs(p - q) > 1e-8)
+    p1, q1 = p[idxs], q[idxs]
+    t1 = p1 + q1
+    t2 = p1 * q1 * (np.log(p1) - np.log(q1)) / (p1 - q1)
+    total += np.sum(0.25 * t1 - 0.5 * t2)
     return total * scaling_factor
-
-
-# k-means through pytorch on cuda
-class KMeans:
-    def __init__(
-        self, n_clusters, n_init=10, max_iter=300, min_variation=1e-3, device="cuda"
-    ):
-        self.n_clusters = n_clusters
-        self.n_init = n_init
-        self.max_iter = max_iter
-        self.min_variation = min_variation
-        self.device = device
-
-    def fit(self, encodings):
-        if self.n_clusters < 1:
-            raise Exception(
-                f"the number of clusters should be >=1, but got {self.n_clusters}"
-            )
-        if self.n_clusters == 1:
-            clusters = [list(range(encodings.shape[0]))]
-        else:
-            best_group_index, min_loss = None, 1e10
-            for init in range(self.n_init):
-                loss = np.nan
-                while np.isnan(loss):
-                    group_index, loss = self.fit_once(encodings, init)
-                if loss < min_loss:
-                    best_group_index = group_index
-            clusters = [[] for _ in range(self.n_clusters)]
-            for i, index in enumerate(best_group_index.tolist()):
-                clusters[index].append(i)
-        return clusters
-
-    @torch.no_grad()
-    def fit_once(self, encodings, init):
-        encodings = torch.nn.functional.normalize(encodings.to(self.device), dim=-1)
-
-        unique_encodings = torch.unique(encodings, dim=0)
-        if unique_encodings.shape[0] < self.n_clusters:
-            self.n_clusters = unique_encodings.shape[0]
-        centers = None
-        ceil = torch.Tensor([1.0]).to(self.device)
-        for i, idx in enumerate(torch.randperm(unique_encodings.shape[0]).tolist()):
-            if i == 0:
-                centers = unique_encodings[idx].unsqueeze(0)
-                continue
-            new_center = unique_encodings[idx].unsqueeze(0)
-            if not torch.isclose(torch.mm(centers, new_center.T).max(), ceil):
-                centers = torch.cat([centers, new_center], dim=0)
-                if centers.shape[0] == self.n_clusters:
-                    break
-
-        from tqdm import tqdm
-
-        with tqdm(total=self.max_iter, desc=f"KMeans ({init+1}/{self.n_init})") as bar:
-            for iter_step in range(self.max_iter):
-                old_centers = centers
-                group_index, loss = self.group_points(centers, encodings)
-                centers = self.update_centers(group_index, encodings, old_centers)
-                centers_max_movement = (
-                    ((old_centers - centers) ** 2).sum(dim=-1).max().item()
-                )
-                bar.set_description(
-                    f"KMeans ({init+1}/{self.n_init}): "
-                    f"loss: {loss:.3f} | "
-                    f"movement: {centers_max_movement:.3f}"
-                )
-                if centers_max_movement < self.min_variation or np.isnan(loss):
-                    bar.total = iter_step + 1
-                    bar.update(1)
-                    break
-                else:
-                    bar.update(1)
-        return group_index, loss
-
-    @torch.no_grad()
-    def group_points(self, centers, encodings, capacity=int(1e10)):
-        # centers: [n_clusters, hs]
-        # encodings: [N, hs]
-        split_len = capacity // (encodings.shape[0] * centers.shape[0])
-        split_num = np.math.ceil(encodings.shape[0] / split_len)
-        group_index = []
-        loss = 0.0
-        for i in range(split_num):
-            split_encodings = encodings[i * split_len : (i + 1) * split_len, :]
-            split_distances = 1 - torch.mm(split_encodings, centers.T)
-            group_index.append(split_distances.argmin(dim=-1).detach())
-            loss += split_distances.min(dim=-1).values.sum().item()
-        group_index = torch.cat(group_index, dim=0)
-        return group_index, loss  # [n_clusters], float
-
-    @torch.no_grad()
-    def update_centers(self, group_index, encodings, old_centers):
-        # sum_vec = torch.zeros([self.n_clusters, encodings.shape[1]],
-        #                      dtype=encodings.dtype, device=self.device)
-        sum_vec = old_centers * 1e-6
-        count_vec = torch.zeros([self.n_clusters], device=self.device) + 1e-6
-        index = group_index.unsqueeze(1).repeat(
-            1, encodings.shape[1]
-        )  # [n_clusters, hs]
-        sum_vec = sum_vec.scatter_add_(dim=0, index=index, src=encodings)
-        count_vec = count_vec.scatter_add_(
-            dim=0, index=group_index, src=torch.ones_like(group_index).float()
-        )
-        mean_vec = sum_vec.div_(count_vec.unsqueeze(1))
-        centers = torch.nn.functional.normalize(mean_vec, dim=-1)
-        return centers
@@ -0,0 +1,172 @@
+# License: GPLv3
+# k-means through pytorch on cuda
+import math
+
+import numpy as np
+import torch
+from tqdm.auto import tqdm
+
+
+class KMeans:
+    def __init__(
+        self,
+        n_clusters,
+        n_init=10,
+        max_iter=300,
+        min_variation=1e-3,
+        device="cuda",
+        seed=None,
+        check_every=10,
+        use_compile=False,
+        matmul_dtype=None,
+        verbose=False,
+    ):
+        self.n_clusters = n_clusters
+        self.n_init = n_init
+        self.max_iter = max_iter
+        self.min_variation = min_variation
+        self.device = device
+        self.seed = seed
+        self.check_every = check_every
+        # e.g. torch.bfloat16 to compute the distances on tensor cores; the centers
+        # and the loss are kept in the precision of the input
+        self.matmul_dtype = matmul_dtype
+        self.verbose = verbose
+        self.generator = None
+        self.step_fn = self.step
+        if use_compile and hasattr(torch, "compile"):
+            # shapes are fixed across iterations, so specialize on them; CUDA graphs
+            # ("reduce-overhead") are not used since the centers returned by one
+            # iteration are the input of the next
+            self.step_fn = torch.compile(self.step, dynamic=False)
+
+    def fit(self, encodings):
+        if self.n_clusters < 1:
+            raise Exception(
+                f"the number of clusters should be >=1, but got {self.n_clusters}"
+            )
+        if self.seed is not None:
+            self.generator = torch.Generator(device=self.device)
+            self.generator.manual_seed(self.seed)
+        if self.n_clusters == 1:
+            best_group_index = torch.zeros(
+                encodings.shape[0], dtype=torch.long, device=encodings.device
+            )
+        else:
+            encodings = encodings.to(self.device)
+            results = []
+            for init in range(self.n_init):
+                loss = np.nan
+                while np.isnan(loss):
+                    group_index, loss = self.fit_once(encodings, init)
+                results.append((loss, group_index))
+            min_loss, best_group_index = min(results, key=lambda result: result[0])
+        return best_group_index  # [N], cluster of each point
+
+    @torch.no_grad()
+    def fit_once(self, encodings, init):
+        encodings = torch.nn.functional.normalize(encodings.to(self.device), dim=-1)
+
+        # k-means++ initialization (cosine distances of unit vectors are the squared
+        # euclidean distances up to a factor 2)
+        generator = self.generator
+        first = torch.randint(
+            encodings.shape[0], (1,), generator=generator, device=encodings.device
+        )
+        centers = encodings[first]
+        min_distances = self.distances_to(encodings, centers)
+        for _ in range(self.n_clusters - 1):
+            if min_distances.sum() <= 0:
+                # fewer distinct points than clusters
+                break
+            idx = torch.multinomial(min_distances, 1, generator=generator)
+            centers = torch.cat([centers, encodings[idx]], dim=0)
+            min_distances = torch.minimum(
+                min_distances, self.distances_to(encodings, encodings[idx])
+            )
+        self.n_clusters = centers.shape[0]
+
+        mm_encodings = encodings
+        if self.matmul_dtype is not None:
+            mm_encodings = encodings.to(self.matmul_dtype)
+        with tqdm(
+            total=self.max_iter,
+            desc=f"KMeans ({init+1}/{self.n_init})",
+            disable=not self.verbose,
+        ) as bar:
+            for iter_step in range(self.max_iter):
+                centers, group_index, loss, centers_max_movement = self.step_fn(
+                    centers, encodings, mm_encodings
+                )
+                if (iter_step + 1) % self.check_every != 0:
+                    continue
+                # only sync with the device every `check_every` iterations
+                if self.verbose:
+                    bar.set_description(
+                        f"KMeans ({init+1}/{self.n_init}): "
+                        f"loss: {loss.item():.3f} | "
+                        f"movement: {centers_max_movement.item():.3f}"
+                    )
+                bar.update(self.check_every)
+                converged = torch.logical_or(
+                    centers_max_movement < self.min_variation, loss.isnan()
+                )
+                if converged.item():
+                    bar.total = iter_step + 1
+                    bar.refresh()
+                    break
+        return group_index, loss.item()
+
+    @torch.no_grad()
+    def step(self, centers, encodings, mm_encodings):
+        # one Lloyd iteration; mm_encodings are the encodings in `matmul_dtype`
+        group_index, loss = self.group_points(centers, mm_encodings)
+        new_centers = self.update_centers(group_index, encodings, centers)
+        centers_max_movement = ((centers - new_centers) ** 2).sum(dim=-1).max()
+        return new_centers, group_index, loss, centers_max_movement
+
+    @staticmethod
+    def distances_to(encodings, center, tol=1e-6):
+        # encodings: [N, hs], center: [1, hs]
+        distances = 1 - torch.mm(encodings, center.T).squeeze(1)
+        return distances.masked_fill_(distances < tol, 0)  # [N]
+
+    @torch.no_grad()
+    def group_points(self, centers, encodings, capacity=2 ** 30):
+        # centers: [n_clusters, hs]
+        # encodings: [N, hs], possibly in a lower precision than centers
+        # capacity: memory budget (in bytes) for the distance matrix of one split
+        # the distance 1 - x.c is minimized by maximizing the similarity x.c, which
+        # keeps the subtraction (and the loss) in the precision of the centers
+        mm_centers = centers.to(encodings.dtype)
+        split_len = max(1, capacity // (centers.shape[0] * encodings.element_size()))
+        if encodings.shape[0] <= split_len:
+            similarities, group_index = torch.mm(encodings, mm_centers.T).max(dim=-1)
+            loss = (1 - similarities.to(centers.dtype)).sum()
+            return group_index, loss  # [N], scalar tensor
+        split_num = math.ceil(encodings.shape[0] / split_len)
+        group_index = []
+        loss = torch.zeros((), dtype=centers.dtype, device=encodings.device)
+        for i in range(split_num):
+            split_encodings = encodings[i * split_len : (i + 1) * split_len, :]
+            similarities, split_group_index = torch.mm(
+                split_encodings, mm_centers.T
+            ).max(dim=-1)
+            group_index.append(split_group_index)
+            loss += (1 - similarities.to(centers.dtype)).sum()
+        group_index = torch.cat(group_index, dim=0)
+        return group_index, loss  # [N], scalar tensor
+
+    @torch.no_grad()
+    def update_centers(self, group_index, encodings, old_centers):
+        sum_vec = old_centers * 1e-6
+        sum_vec.index_add_(0, group_index, encodings)  # [n_clusters, hs]
+        count_vec = torch.full(
+            [self.n_clusters], 1e-6, dtype=encodings.dtype, device=encodings.device
+        )
+        count_vec.index_add_(
+            0, group_index, torch.ones_like(group_index, dtype=encodings.dtype)
+        )
+        mean_vec = sum_vec.div_(count_vec.unsqueeze(1))
+        centers = torch.nn.functional.normalize(mean_vec, dim=-1)
+        return centers
@@ -120,7 +120,14 @@ def featurize_tokens_from_model(model, tokenized_texts, batch_size, name="", ver
         for hidden_state, sent_length in zip(outs.hidden_states[-1], chunk_sent_length):
             h.append(hidden_state[sent_length - 1])
         h = torch.stack(h, dim=0)
-        feats.append(h.cpu())
+        if h.is_cuda:
+            # copy to pinned memory asynchronously so that it overlaps with the next batch
+            h_cpu = torch.empty(h.shape, dtype=h.dtype, pin_memory=True)
+            feats.append(h_cpu.copy_(h, non_blocking=True))
+        else:
+            feats.append(h)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
     t2 = time.time()
     if verbose:
         print(f'Featurize time: {round(t2-t1, 2)}')
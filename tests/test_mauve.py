@@ -2,10 +2,20 @@ import math
 
 import numpy as np
 import pytest
+import torch
+from sklearn.metrics import auc
 
 import mauve
 from examples import load_gpt2_dataset
-from mauve.compute_mauve import get_features_from_input
+from mauve.kmeans import KMeans
+from mauve.compute_mauve import (
+    CLUSTER_CACHE,
+    cluster_feats,
+    compute_area_under_curve,
+    get_divergence_curve_for_multinomials,
+    get_features_from_input,
+    get_fronter_integral,
+)
 
 
 class TestMauve:
@@ -56,3 +66,132 @@ class TestMauve:
         norm_of_difference = np.linalg.norm(p_features_original - p_features_batched, axis=1)  # shape = (n,)
         # ensure that new features are close to old features
         assert np.max(norm_of_difference) < 1e-5 * np.max(np.linalg.norm(p_features_original, axis=1))
+
+    def test_frontier_integral(self):
+        rng = np.random.RandomState(0)
+        p, q = rng.dirichlet(np.ones(50)), rng.dirichlet(np.ones(50))
+        p[:5] = 0
+        q[3:8] = 0
+        q[10] = p[10]
+        p, q = p / p.sum(), q / q.sum()
+        expected = 0.0
+        for p1, q1 in zip(p, q):
+            if p1 == 0 and q1 == 0:
+                pass
+            elif p1 == 0:
+                expected += q1 / 4
+            elif q1 == 0:
+                expected += p1 / 4
+            elif abs(p1 - q1) > 1e-8:
+                expected += 0.25 * (p1 + q1) - 0.5 * p1 * q1 * (math.log(p1) - math.log(q1)) / (p1 - q1)
+        assert math.isclose(get_fronter_integral(p, q), 2 * expected, rel_tol=1e-12)
+        assert get_fronter_integral(p, p) == 0
+
+    def test_divergence_curve(self):
+        rng = np.random.RandomState(0)
+        p, q = rng.dirichlet(np.ones(50)), rng.dirichlet(np.ones(50))
+        p[:5] = 0
+        q[3:8] = 0
+        p, q = p / p.sum(), q / q.sum()
+        mixture_weights = np.linspace(1e-6, 1 - 1e-6, 25)
+
+        def kl(a, b):
+            idxs = a != 0
+            return np.sum(a[idxs] * np.log(a[idxs] / b[idxs]))
+
+        expected = [[0, np.inf]]
+        for w in mixture_weights:
+            r = w * p + (1 - w) * q
+            expected.append([kl(q, r), kl(p, r)])
+        expected.append([np.inf, 0])
+        expected = np.exp(-5 * np.asarray(expected))
+        out = get_divergence_curve_for_multinomials(p, q, mixture_weights[::-1], 5)
+        assert out.shape == (27, 2)
+        assert np.allclose(out, expected, rtol=1e-12, atol=0)
+
+    def test_area_under_curve(self):
+        rng = np.random.RandomState(0)
+        x, y = np.sort(rng.rand(27)), rng.rand(27)
+        x[:3] = 0
+        assert math.isclose(compute_area_under_curve(x, y), auc(x, y), rel_tol=1e-12)
+
+    def test_cluster_cache(self):
+        rng = np.random.RandomState(0)
+        p, q = rng.randn(500, 32), rng.randn(500, 32) + 0.5
+        CLUSTER_CACHE.clear()
+        p_hist, q_hist = cluster_feats(p, q, num_clusters=10, max_iter=20)
+        assert len(CLUSTER_CACHE) == 1
+        p_hist_cached, q_hist_cached = cluster_feats(p, q, num_clusters=10, max_iter=20)
+        assert len(CLUSTER_CACHE) == 1
+        assert np.array_equal(p_hist, p_hist_cached) and np.array_equal(q_hist, q_hist_cached)
+        cluster_feats(p, q + 1, num_clusters=10, max_iter=20)
+        assert len(CLUSTER_CACHE) == 2
+
+    def test_kmeans_keeps_best_init(self, monkeypatch):
+        losses = iter([3.0, 1.0, 2.0])
+
+        def fit_once(encodings, init):
+            return torch.full((encodings.shape[0],), init), next(losses)
+
+        kmeans = KMeans(n_clusters=2, n_init=3, device="cpu")
+        monkeypatch.setattr(kmeans, "fit_once", fit_once)
+        assert torch.equal(kmeans.fit(torch.randn(5, 3)), torch.full((5,), 1))
+
+    def test_kmeans_seed(self):
+        encodings = torch.from_numpy(np.random.RandomState(0).randn(500, 16))
+        labels = KMeans(n_clusters=20, n_init=2, device="cpu", seed=1).fit(encodings)
+        labels_again = KMeans(n_clusters=20, n_init=2, device="cpu", seed=1).fit(encodings)
+        assert torch.equal(labels, labels_again)
+
+    def test_kmeans_fewer_distinct_points_than_clusters(self):
+        points = np.random.RandomState(0).randn(5, 8)
+        encodings = torch.from_numpy(np.repeat(points, 10, axis=0))
+        kmeans = KMeans(n_clusters=8, n_init=2, device="cpu", seed=1)
+        labels = kmeans.fit(encodings)
+        assert kmeans.n_clusters == 5
+        assert np.array_equal(np.bincount(labels.numpy()), [10] * 5)
+
+    def test_cluster_feats_torch_backend(self):
+        rng = np.random.RandomState(0)
+        p, q = rng.randn(300, 32), rng.randn(300, 32) + 0.5
+        p_hist, q_hist = cluster_feats(
+            p, q, num_clusters=10, max_iter=50, seed=3, kmeans_backend="torch"
+        )
+        for hist in [p_hist, q_hist]:
+            assert hist.shape == (10,)
+            assert np.all(hist >= 0) and math.isclose(hist.sum(), 1)
+
+    def test_kmeans_group_points_splits(self):
+        rng = np.random.RandomState(0)
+        encodings = torch.nn.functional.normalize(torch.from_numpy(rng.randn(100, 16)), dim=-1)
+        centers = encodings[:7]
+        kmeans = KMeans(n_clusters=7, device="cpu")
+        group_index, loss = kmeans.group_points(centers, encodings)
+        # room for 33 rows of distances per split, so 4 splits
+        split_group_index, split_loss = kmeans.group_points(
+            centers, encodings, capacity=7 * encodings.element_size() * 33
+        )
+        assert torch.equal(group_index, split_group_index)
+        assert torch.isclose(loss, split_loss)
+
+    def test_kmeans_bfloat16_matmul(self):
+        rng = np.random.RandomState(0)
+        encodings = torch.nn.functional.normalize(torch.from_numpy(rng.randn(2000, 64)), dim=-1)
+        centers = encodings[:50]
+        kmeans = KMeans(n_clusters=50, device="cpu")
+        group_index, loss = kmeans.group_points(centers, encodings)
+        group_index_bf16, loss_bf16 = kmeans.group_points(centers, encodings.bfloat16())
+        assert (group_index == group_index_bf16).double().mean() > 0.95
+        assert loss_bf16.dtype == loss.dtype and torch.isclose(loss, loss_bf16, rtol=1e-2)
+        labels = KMeans(
+            n_clusters=50, n_init=1, device="cpu", seed=1, matmul_dtype=torch.bfloat16
+        ).fit(encodings)
+        assert labels.shape == (2000,) and labels.max() < 50
+
+    def test_kmeans_compile(self):
+        encodings = torch.from_numpy(np.random.RandomState(0).randn(300, 16).astype(np.float32))
+        labels = KMeans(n_clusters=10, n_init=1, max_iter=20, device="cpu", seed=1).fit(encodings)
+        labels_compiled = KMeans(
+            n_clusters=10, n_init=1, max_iter=20, device="cpu", seed=1, use_compile=True
+        ).fit(encodings)
+        assert torch.equal(labels, labels_compiled)